@@ -1,42 +1,70 @@
 import streamlit as st
 import google.generativeai as genai
 import json
+# typing.TypedDict is rejected by pydantic's schema conversion on Python < 3.12.
+from typing_extensions import TypedDict
+
+class SoapSubjective(TypedDict):
+    Chief_Complaint: str
+    History_of_Present_Illness: str
+
+class SoapObjective(TypedDict):
+    Physical_Exam: str
+    Observations: str
+
+class SoapAssessment(TypedDict):
+    Diagnosis: str
+    Severity: str
+
+class SoapPlan(TypedDict):
+    Treatment: str
+    Follow_Up: str
+
+class SoapNote(TypedDict):
+    Subjective: SoapSubjective
+    Objective: SoapObjective
+    Assessment: SoapAssessment
+    Plan: SoapPlan
+
+@st.cache_resource
+def _get_gemini(api_key):
+    # Client construction resolves endpoints and opens sessions; reuse it
+    # across reruns instead of rebuilding on every button click.
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("models/gemini-2.5-pro")
 
 def generate_soap_note_hybrid(api_key, transcript_text):
     try:
-        genai.configure(api_key=api_key)
+        model = _get_gemini(api_key)
     except Exception as e:
         return {"Error": "Authentication failed", "Details": str(e)}
 
-    schema = {
-        "Subjective": {"Chief_Complaint": "", "History_of_Present_Illness": ""},
-        "Objective": {"Physical_Exam": "", "Observations": ""},
-        "Assessment": {"Diagnosis": "", "Severity": ""},
-        "Plan": {"Treatment": "", "Follow_Up": ""}
-    }
-
-    model = genai.GenerativeModel("models/gemini-2.5-pro")
-    prompt = f"Convert this transcript into a concise JSON object following this schema:\n{json.dumps(schema)}\n\nTranscript:\n{transcript_text}"
+    prompt = f"Convert this transcript into a concise SOAP note.\n\nTranscript:\n{transcript_text}"
 
     try:
-        response = model.generate_content(prompt)
-        text = getattr(response, "text", None)
-        if not text and hasattr(response, "candidates"):
-            text = response.candidates[0].content.parts[0].text
-        cleaned = text.replace('```json', '').replace('```', '').strip()
-        data = json.loads(cleaned)
+        # response_schema constrains the output to the SoapNote structure, so
+        # the schema no longer rides along in the prompt, the reply is
+        # guaranteed parseable JSON, and no post-hoc field patching is needed.
+        stream = model.generate_content(
+            prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": SoapNote,
+            },
+            stream=True,
+        )
+        placeholder = st.empty()
+        buffer = ""
+        for chunk in stream:
+            chunk_text = getattr(chunk, "text", None)
+            if chunk_text:
+                buffer += chunk_text
+                placeholder.code(buffer, language="json")
+        placeholder.empty()
+        return json.loads(buffer)
     except Exception as e:
         return {"Error": "Model parsing failed", "Details": str(e)}
 
-    # Ensure structure completeness
-    for section, fields in schema.items():
-        if section not in data:
-            data[section] = fields
-        else:
-            for f, _ in fields.items():
-                data[section].setdefault(f, "Not specified")
-    return data
-
 # ---------- Streamlit UI ----------
 st.set_page_config(layout="wide")
 st.title("🩺 Hybrid AI SOAP Note Generator")
@@ -1,71 +1,271 @@
 import streamlit as st
-import json, re, functools
+import importlib.util
+import json, os, re, threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+# typing.TypedDict is rejected by pydantic's schema conversion on Python < 3.12.
+from typing_extensions import TypedDict
 from collections import defaultdict
 
+# Faster cold starts: parallel Rust downloader for model weights, plus a
+# persistent cache volume when one is mounted. setdefault keeps any values
+# already set by the deployment. huggingface-hub hard-errors if the flag is
+# set without the hf_transfer package, so only enable it when importable.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+if os.path.isdir("/data"):
+    os.environ.setdefault("HF_HOME", "/data/hf-cache")
+
 # ---------- Optional imports ----------
 try:
-    from transformers import pipeline
+    import torch
+    from torch import nn
+    from transformers import pipeline, ZeroShotClassificationPipeline
     TRANSFORMERS_AVAILABLE = True
 except ImportError:
     TRANSFORMERS_AVAILABLE = False
+    CachedHypothesisZeroShot = None
     st.error("Transformers library not installed. Please run: pip install transformers torch")
 
+try:
+    import bitsandbytes  # noqa: F401
+    BNB_AVAILABLE = True
+except ImportError:
+    BNB_AVAILABLE = False
+
+try:
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    ORT_AVAILABLE = True
+except ImportError:
+    ORT_AVAILABLE = False
+
 try:
     import google.generativeai as genai
     GENAI_AVAILABLE = True
 except ImportError:
     GENAI_AVAILABLE = False
 
+try:
+    import numba
+    import numpy as np
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 # ---------- Utility ----------
+# Matches "Patient: ..." lines in one C-level pass; \S excludes empty utterances.
+_PATIENT_RE = re.compile(r"(?im)^[ \t]*patient:[ \t]*(\S.*?)\s*$")
+
+if NUMBA_AVAILABLE:
+    @numba.njit(cache=True)
+    def _scan_patient_spans(buf):
+        n = buf.size
+        lines = 1
+        for i in range(n):
+            if buf[i] == 10:
+                lines += 1
+        starts = np.empty(lines, np.int64)
+        ends = np.empty(lines, np.int64)
+        count = 0
+        pos = 0
+        while pos < n:
+            end = pos
+            while end < n and buf[end] != 10:
+                end += 1
+            i = pos
+            while i < end and (buf[i] == 32 or buf[i] == 9):
+                i += 1
+            # Case-insensitive "patient:" prefix; | 0x20 lower-cases ASCII letters.
+            if end - i >= 8 and \
+               (buf[i] | 0x20) == 112 and (buf[i + 1] | 0x20) == 97 and \
+               (buf[i + 2] | 0x20) == 116 and (buf[i + 3] | 0x20) == 105 and \
+               (buf[i + 4] | 0x20) == 101 and (buf[i + 5] | 0x20) == 110 and \
+               (buf[i + 6] | 0x20) == 116 and buf[i + 7] == 58:
+                j = i + 8
+                while j < end and (buf[j] == 32 or buf[j] == 9):
+                    j += 1
+                k = end
+                while k > j and (buf[k - 1] == 32 or buf[k - 1] == 9 or buf[k - 1] == 13):
+                    k -= 1
+                if k > j:
+                    starts[count] = j
+                    ends[count] = k
+                    count += 1
+            pos = end + 1
+        return starts[:count], ends[:count]
+
+    # Trigger JIT compilation off the main thread so the first transcript
+    # upload doesn't pay the compile cost.
+    threading.Thread(
+        target=lambda: _scan_patient_spans(np.frombuffer(b"patient: warmup\n", dtype=np.uint8)),
+        daemon=True,
+    ).start()
+
 def read_txt(file) -> str:
     return file.read().decode("utf-8")
 
 def isolate_patient_dialogue(transcript: str) -> list:
-    patient_lines = []
-    for line in transcript.splitlines():
-        line = line.strip()
-        if line.lower().startswith("patient:"):
-            utterance = line[len("patient:"):].strip()
-            if utterance:
-                patient_lines.append(utterance)
-    return patient_lines
+    if NUMBA_AVAILABLE:
+        raw = transcript.encode("utf-8")
+        starts, ends = _scan_patient_spans(np.frombuffer(raw, dtype=np.uint8))
+        return [raw[s:e].decode("utf-8") for s, e in zip(starts, ends)]
+    return _PATIENT_RE.findall(transcript)
+
+if TRANSFORMERS_AVAILABLE:
+    class CachedHypothesisZeroShot(ZeroShotClassificationPipeline):
+        """Zero-shot pipeline that tokenizes each hypothesis and premise once.
+
+        The stock pipeline re-tokenizes the fixed "This example is {label}."
+        hypotheses for every premise/label pair (5N tokenizations for N
+        utterances); here the token ids are cached and spliced per pair.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._encoding_cache = {}
+
+        def _encode_once(self, text):
+            ids = self._encoding_cache.get(text)
+            if ids is None:
+                if len(self._encoding_cache) > 4096:
+                    self._encoding_cache.clear()
+                ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+                self._encoding_cache[text] = ids
+            return ids
+
+        def _parse_and_tokenize(self, sequence_pairs, **kwargs):
+            # preprocess() hands over one (premise, hypothesis) pair at a time.
+            premise, hypothesis = sequence_pairs[0]
+            return self.tokenizer.prepare_for_model(
+                self._encode_once(premise),
+                self._encode_once(hypothesis),
+                truncation="only_first",
+                return_tensors=self.framework,
+                prepend_batch_axis=True,
+            )
 
 # ---------- Cached pipelines ----------
+def _warmup(p, task):
+    # One dummy call so the first real request doesn't pay compile cost.
+    try:
+        if task == "question-answering":
+            p(question="What is this?", context="Warmup context.")
+        elif task == "zero-shot-classification":
+            p("Warmup.", candidate_labels=["warmup"])
+        else:
+            p("Warmup.")
+    except Exception:
+        pass
+
 @st.cache_resource
 def get_pipeline(task, model, **kwargs):
     if not TRANSFORMERS_AVAILABLE: return None
-    return pipeline(task, model=model, **kwargs)
+    cuda = torch.cuda.is_available()
+    kwargs.setdefault("model_kwargs", {}).update({"low_cpu_mem_usage": True})
+    if cuda and BNB_AVAILABLE:
+        kwargs["model_kwargs"].update({"load_in_8bit": True, "device_map": "auto"})
+        p = pipeline(task, model=model, **kwargs)
+    elif cuda:
+        # FP16 halves VRAM so bigger batches fit, and unlocks tensor-core
+        # throughput on the two -large models.
+        p = pipeline(task, model=model, device=0, torch_dtype=torch.float16, **kwargs)
+    else:
+        p = pipeline(task, model=model, **kwargs)
+        # On CPU, int8-quantizing the Linear layers quarters weight memory and
+        # roughly halves inference time on the larger models.
+        p.model = torch.quantization.quantize_dynamic(p.model, {nn.Linear}, dtype=torch.qint8)
+    # Compiling here means it happens once per process, inside the
+    # cache_resource boundary, and every rerun reuses the optimized graph.
+    p.model = torch.compile(p.model, mode="reduce-overhead", fullgraph=False)
+    _warmup(p, task)
+    return p
 
 # ---------- Loaders ----------
-get_medical_ner = functools.lru_cache(None)(lambda: get_pipeline("ner", "d4data/biomedical-ner-all", aggregation_strategy="simple"))
-get_general_ner = functools.lru_cache(None)(lambda: get_pipeline("ner", "dbmdz/bert-large-cased-finetuned-conll03-english", aggregation_strategy="simple"))
-get_qa = functools.lru_cache(None)(lambda: get_pipeline("question-answering", "deepset/roberta-large-squad2"))
-get_sentiment = functools.lru_cache(None)(lambda: get_pipeline("text-classification", "distilbert-base-uncased-finetuned-sst-2-english"))
-get_intent = functools.lru_cache(None)(lambda: get_pipeline("zero-shot-classification", "facebook/bart-large-mnli"))
+MEDICAL_NER_MODEL = "d4data/biomedical-ner-all"
+GENERAL_NER_MODEL = "dbmdz/bert-large-cased-finetuned-conll03-english"
+QA_MODEL = "deepset/roberta-large-squad2"
+SENTIMENT_MODEL = "distilbert-base-uncased-finetuned-sst-2-english"
+INTENT_MODEL = "facebook/bart-large-mnli"
+
+def get_medical_ner():
+    return get_pipeline("ner", MEDICAL_NER_MODEL, aggregation_strategy="first")
+
+def get_general_ner():
+    return get_pipeline("ner", GENERAL_NER_MODEL, aggregation_strategy="simple")
+
+def get_qa():
+    return get_pipeline("question-answering", QA_MODEL, doc_stride=128, max_seq_len=384)
+
+# INT8 ONNX export of the sentiment model, produced once with:
+#   optimum-cli export onnx --model distilbert-base-uncased-finetuned-sst-2-english sst2-onnx/
+#   optimum-cli onnxruntime quantize --avx512 --onnx_model sst2-onnx -o sst2-onnx-int8
+SENTIMENT_ONNX_DIR = "sst2-onnx-int8"
+
+@st.cache_resource
+def get_sentiment():
+    if TRANSFORMERS_AVAILABLE and ORT_AVAILABLE and os.path.isdir(SENTIMENT_ONNX_DIR):
+        from transformers import AutoTokenizer
+        model = ORTModelForSequenceClassification.from_pretrained(SENTIMENT_ONNX_DIR, provider="CPUExecutionProvider")
+        tokenizer = AutoTokenizer.from_pretrained(SENTIMENT_ONNX_DIR)
+        return pipeline("text-classification", model=model, tokenizer=tokenizer, batch_size=32)
+    return get_pipeline("text-classification", SENTIMENT_MODEL, batch_size=32)
+
+def get_intent():
+    return get_pipeline("zero-shot-classification", INTENT_MODEL, batch_size=16, pipeline_class=CachedHypothesisZeroShot)
+
+INTENT_LABELS = ("Seeking reassurance", "Reporting symptoms", "Expressing concern", "Expressing gratitude", "Reporting outcome")
+
+# ---------- Cached inference ----------
+# Streamlit reruns the whole script on every widget change; memoize model
+# outputs keyed on the input text and model id so repeat runs skip inference.
+@st.cache_data(show_spinner=False, persist="disk")
+def _cached_ner(text, model_id):
+    ner = get_medical_ner() if model_id == MEDICAL_NER_MODEL else get_general_ner()
+    return ner(text)
+
+@st.cache_data(show_spinner=False, persist="disk")
+def _cached_qa(context, questions, model_id):
+    qa = get_qa()
+    inputs = [{"question": q, "context": context} for q in questions]
+    results = qa(inputs, batch_size=len(inputs), handle_impossible_answer=True)
+    return [results] if isinstance(results, dict) else results
+
+@st.cache_data(show_spinner=False, persist="disk")
+def _cached_sentiment(lines, model_id):
+    return get_sentiment()(list(lines), batch_size=32, truncation=True)
+
+@st.cache_data(show_spinner=False, persist="disk")
+def _cached_intent(lines, labels, model_id):
+    return get_intent()(list(lines), candidate_labels=list(labels), multi_label=False, batch_size=16)
 
 # ---------- Extraction ----------
+_TITLE_RE = re.compile(r"(?:Mr\.|Ms\.|Mrs\.)\s+[A-Za-z]+")
+
 def extract_patient_name(text):
-    general_ner = get_general_ner()
-    if not general_ner:
+    # Fast path first: an explicit "Mr./Ms./Mrs. Name" mention answers the
+    # question without running the 1.3 GB general NER model at all.
+    match = _TITLE_RE.search(text)
+    if match:
+        return match.group(0)
+    if not get_general_ner():
         return None
-    results = general_ner(text)
+    results = _cached_ner(text, GENERAL_NER_MODEL)
     for r in results:
         if r['entity_group'] == 'PER':
             return r['word']
-    match = re.search(r"(?:Mr\.|Ms\.|Mrs\.)\s+[A-Za-z]+", text)
-    return match.group(0) if match else None
+    return None
 
 def extract_medical_info(text):
-    medical_ner = get_medical_ner()
-    if not medical_ner:
+    if not get_medical_ner():
         return {}
-    results = medical_ner(text)
+    results = _cached_ner(text, MEDICAL_NER_MODEL)
     extracted = defaultdict(list)
     for ent in results:
         group = ent['entity_group']
-        word = ent['word'].replace("##", "")
+        # Slice the span out of the transcript via the pipeline's offsets:
+        # exact surface text, no sub-word patching.
+        word = text[ent['start']:ent['end']]
         if group == "Sign_symptom":
             extracted["Symptoms"].append(word)
         elif group in ["Medication", "Therapeutic_procedure", "Diagnostic_procedure"]:
@@ -73,8 +273,7 @@ def extract_medical_info(text):
     return dict(extracted)
 
 def extract_qa_info(context):
-    qa = get_qa()
-    if not qa:
+    if not get_qa():
         return {}
     questions = {
         "Diagnosis": "What was the patient diagnosed with?",
@@ -82,13 +281,13 @@ def extract_qa_info(context):
         "Prognosis": "What is the doctor's prognosis?"
     }
     answers = {}
-    for key, q in questions.items():
-        try:
-            res = qa(question=q, context=context)
-            if res["score"] > 0.1:
-                answers[key] = res["answer"]
-        except Exception:
-            continue
+    try:
+        results = _cached_qa(context, tuple(questions.values()), QA_MODEL)
+    except Exception:
+        return answers
+    for key, res in zip(questions.keys(), results):
+        if res["score"] > 0.1:
+            answers[key] = res["answer"]
     return answers
 
 # ---------- Sentiment & Intent ----------
@@ -98,11 +297,19 @@ def analyze_sentiment(patient_lines):
     if not sentiment_pl or not intent_pl:
         st.error("Models not loaded.")
         return []
-    labels = ["Seeking reassurance", "Reporting symptoms", "Expressing concern", "Expressing gratitude", "Reporting outcome"]
+    # Sort by exact token length so batches pad to similar sequence lengths
+    # (padded forward time is linear in the longest member), then restore order.
+    lens = [len(sentiment_pl.tokenizer.encode(line, add_special_tokens=False)) for line in patient_lines]
+    order = sorted(range(len(patient_lines)), key=lens.__getitem__)
+    sorted_lines = tuple(patient_lines[idx] for idx in order)
+    sentiments = [None] * len(patient_lines)
+    intents = [None] * len(patient_lines)
+    for idx, s in zip(order, _cached_sentiment(sorted_lines, SENTIMENT_MODEL)):
+        sentiments[idx] = s
+    for idx, i in zip(order, _cached_intent(sorted_lines, INTENT_LABELS, INTENT_MODEL)):
+        intents[idx] = i
     results = []
-    for text in patient_lines:
-        s = sentiment_pl(text)[0]
-        i = intent_pl(text, candidate_labels=labels)
+    for text, s, i in zip(patient_lines, sentiments, intents):
         results.append({
             "text": text,
             "sentiment": s["label"],
@@ -113,28 +320,97 @@ def analyze_sentiment(patient_lines):
     return results
 
 # ---------- SOAP Note ----------
+class SoapSubjective(TypedDict):
+    Chief_Complaint: str
+    History_of_Present_Illness: str
+
+class SoapObjective(TypedDict):
+    Physical_Exam: str
+    Observations: str
+
+class SoapAssessment(TypedDict):
+    Diagnosis: str
+    Severity: str
+
+class SoapPlan(TypedDict):
+    Treatment: str
+    Follow_Up: str
+
+class SoapNote(TypedDict):
+    Subjective: SoapSubjective
+    Objective: SoapObjective
+    Assessment: SoapAssessment
+    Plan: SoapPlan
+
+@st.cache_resource
+def _get_gemini(api_key):
+    # Client construction resolves endpoints and opens sessions; reuse it
+    # across reruns instead of rebuilding on every button click.
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('models/gemini-2.5-pro')
+
 def generate_soap_note(api_key, transcript):
     if not GENAI_AVAILABLE:
         return {"Error": "google-generativeai not installed."}
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('models/gemini-2.5-pro')
-        schema = """
-        {"Subjective":{"Chief_Complaint":"","History_of_Present_Illness":""},
-         "Objective":{"Physical_Exam":"","Observations":""},
-         "Assessment":{"Diagnosis":"","Severity":""},
-         "Plan":{"Treatment":"","Follow_Up":""}}
-        """
-        prompt = f"Convert the following transcript to JSON with this schema:\n{schema}\n\nTranscript:\n{transcript}"
-        response = model.generate_content(prompt)
-        text = getattr(response, "text", None)
-        if not text and hasattr(response, "candidates"):
-            text = response.candidates[0].content.parts[0].text
-        cleaned = text.replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned)
+        model = _get_gemini(api_key)
+        prompt = f"Convert the following transcript into a concise SOAP note.\n\nTranscript:\n{transcript}"
+        # response_schema constrains the output to the SoapNote structure, so
+        # the schema no longer rides along in the prompt and the reply is
+        # guaranteed parseable JSON.
+        stream = model.generate_content(
+            prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": SoapNote,
+            },
+            stream=True,
+        )
+        placeholder = st.empty()
+        buffer = ""
+        for chunk in stream:
+            chunk_text = getattr(chunk, "text", None)
+            if chunk_text:
+                buffer += chunk_text
+                placeholder.code(buffer, language="json")
+        placeholder.empty()
+        return json.loads(buffer)
     except Exception as e:
         return {"Error": str(e)}
 
+def generate_soap_notes_batch(api_key, transcripts):
+    if not GENAI_AVAILABLE:
+        return [{"Error": "google-generativeai not installed."}] * len(transcripts)
+    try:
+        model = _get_gemini(api_key)
+    except Exception as e:
+        return [{"Error": str(e)}] * len(transcripts)
+    prompts = [f"Convert the following transcript into a concise SOAP note.\n\nTranscript:\n{t}" for t in transcripts]
+    # Fire all requests concurrently from worker threads; wall time is
+    # max-of-N instead of sum. Sync generate_content is deliberate: the SDK's
+    # async client binds to the first event loop it sees, which would be
+    # closed after one asyncio.run and break every later batch from the
+    # cached model.
+    with ThreadPoolExecutor(max_workers=min(8, len(prompts))) as executor:
+        futures = [
+            executor.submit(
+                model.generate_content,
+                prompt,
+                generation_config={
+                    "response_mime_type": "application/json",
+                    "response_schema": SoapNote,
+                },
+            )
+            for prompt in prompts
+        ]
+    notes = []
+    for future in futures:
+        try:
+            notes.append(json.loads(future.result().text))
+        except Exception as e:
+            notes.append({"Error": str(e)})
+    return notes
+
 # ---------- Streamlit Layout ----------
 st.set_page_config(page_title="Physician Notetaker", layout="wide")
 st.title("🩺 AI Physician Notetaker")
@@ -155,9 +431,17 @@ if file:
 
     # Clinical Summary
     st.subheader("1️⃣ Clinical Summary")
-    patient_name = extract_patient_name(transcript)
-    med_info = extract_medical_info(transcript)
-    qa_info = extract_qa_info(transcript)
+    # Load each model once up front so the worker threads never race on downloads.
+    get_general_ner(); get_medical_ner(); get_qa()
+    # The three pipelines are independent and release the GIL in their forward
+    # passes, so overlap them instead of paying sum-of-three wall time.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        name_future = executor.submit(extract_patient_name, transcript)
+        med_future = executor.submit(extract_medical_info, transcript)
+        qa_future = executor.submit(extract_qa_info, transcript)
+        patient_name = name_future.result()
+        med_info = med_future.result()
+        qa_info = qa_future.result()
     summary = {
         "Patient_Name": patient_name,
         "Symptoms": med_info.get("Symptoms", []),
@@ -195,3 +479,22 @@ if file:
             st.json(soap)
             st.download_button("Download SOAP Note", data=json.dumps(soap, indent=2),
                                file_name="soap_note.json")
+
+    # Batch workflow: queue several transcripts, then submit them in one
+    # concurrent round instead of blocking on each SOAP call in turn.
+    if st.button("Queue for batch"):
+        st.session_state.setdefault("soap_queue", []).append(transcript)
+    queue = st.session_state.get("soap_queue", [])
+    if queue:
+        st.caption(f"{len(queue)} transcript(s) queued.")
+        if st.button("Submit batch"):
+            if not api_key:
+                st.error("Please enter Google AI Studio Key.")
+            else:
+                with st.spinner(f"Generating {len(queue)} SOAP notes..."):
+                    notes = generate_soap_notes_batch(api_key, queue)
+                st.session_state["soap_queue"] = []
+                st.json(notes)
+                st.download_button("Download Batch SOAP Notes",
+                                   data=json.dumps(notes, indent=2),
+                                   file_name="soap_notes_batch.json")
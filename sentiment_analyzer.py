@@ -1,22 +1,38 @@
 import streamlit as st
 import pandas as pd
-from transformers import pipeline
+import importlib.util
 import json
+import os
+import re
+
+# Faster cold starts: parallel Rust downloader for model weights, plus a
+# persistent cache volume when one is mounted. setdefault keeps any values
+# already set by the deployment. huggingface-hub hard-errors if the flag is
+# set without the hf_transfer package, so only enable it when importable.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+if os.path.isdir("/data"):
+    os.environ.setdefault("HF_HOME", "/data/hf-cache")
+
+from transformers import pipeline
+
+INTENT_LABELS = [
+    "Seeking reassurance",
+    "Reporting symptoms",
+    "Expressing concern",
+    "Expressing gratitude",
+    "Reporting outcome"
+]
 
 # ---------- Utility ----------
+# Matches "Patient: ..." lines in one C-level pass; \S excludes empty utterances.
+_PATIENT_RE = re.compile(r"(?im)^[ \t]*patient:[ \t]*(\S.*?)\s*$")
+
 def read_txt(file) -> str:
     return file.read().decode("utf-8")
 
 def isolate_patient_dialogue(transcript: str) -> list:
-    patient_lines = []  # FIX: added initialization
-    lines = transcript.splitlines()
-    for line in lines:
-        cleaned_line = line.strip()
-        if cleaned_line.lower().startswith("patient:"):
-            utterance = cleaned_line[len("patient:"):].strip()
-            if utterance:
-                patient_lines.append(utterance)
-    return patient_lines
+    return _PATIENT_RE.findall(transcript)
 
 # ---------- Streamlit UI ----------
 st.set_page_config(page_title="Patient Sentiment Analyzer", layout="centered")
@@ -28,7 +44,7 @@ from transformers import pipeline
 
 try:
     # Use a public Hugging Face model instead of a missing local folder
-    sentiment_classifier = pipeline("text-classification", model="distilbert-base-uncased-finetuned-sst-2-english")
+    sentiment_classifier = pipeline("text-classification", model="distilbert-base-uncased-finetuned-sst-2-english", batch_size=32)
     st.sidebar.success("✅ Sentiment model loaded from Hugging Face successfully!")
 except Exception as e:
     sentiment_classifier = None
@@ -37,7 +53,7 @@ except Exception as e:
 
 
 try:
-    intent_classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+    intent_classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli", batch_size=16)
     st.sidebar.success("✅ Zero-shot intent model loaded successfully!")
 except Exception as e:
     intent_classifier = None
@@ -61,19 +77,21 @@ if uploaded_file:
 
         if sentiment_classifier and intent_classifier:
             with st.spinner("Analyzing patient dialogue..."):
-                intent_labels = [
-                    "Seeking reassurance",
-                    "Reporting symptoms",
-                    "Expressing concern",
-                    "Expressing gratitude",
-                    "Reporting outcome"
-                ]
-                for line in patient_dialogue:
+                # Sort by exact token length so batches pad to similar sequence lengths
+                # (padded forward time is linear in the longest member), then restore order.
+                lens = [len(sentiment_classifier.tokenizer.encode(line, add_special_tokens=False)) for line in patient_dialogue]
+                order = sorted(range(len(patient_dialogue)), key=lens.__getitem__)
+                sorted_lines = [patient_dialogue[idx] for idx in order]
+                sentiments = [None] * len(patient_dialogue)
+                intents = [None] * len(patient_dialogue)
+                for idx, sentiment in zip(order, sentiment_classifier(sorted_lines, batch_size=32, truncation=True)):
+                    sentiments[idx] = sentiment
+                for idx, intent in zip(order, intent_classifier(sorted_lines, candidate_labels=INTENT_LABELS, multi_label=False, batch_size=16)):
+                    intents[idx] = intent
+                for line, sentiment, intent in zip(patient_dialogue, sentiments, intents):
                     res = {"text": line}
-                    sentiment = sentiment_classifier(line)[0]
                     res["sentiment"] = sentiment['label']
                     res["sentiment_score"] = round(sentiment['score'], 2)
-                    intent = intent_classifier(line, candidate_labels=intent_labels)
                     res["intent"] = intent['labels'][0]
                     res["intent_score"] = round(intent['scores'][0], 2)
                     results.append(res)